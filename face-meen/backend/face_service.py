@@ -2,34 +2,128 @@
 Face Detection and Embedding Service using InsightFace (ArcFace)
 """
 import base64
+import hashlib
 import os
+import threading
+import time
 import numpy as np
 import cv2
-from typing import Optional, Tuple, List
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING, Optional, Tuple, List
+
+from optional_deps import optional_import
+
+if TYPE_CHECKING:
+    from storage import EmbeddingGallery
+
+DECODE_WORKERS = 8
+EMBEDDING_CACHE_SIZE = 256
+MAX_IMAGE_SIDE = 640.0
+# buffalo_sc เล็กและเร็วกว่า buffalo_l ราว 3 เท่าบน CPU
+FACE_MODEL = os.getenv("FACE_MODEL", "buffalo_sc")
+FACE_PROVIDER = os.getenv("FACE_PROVIDER", "cpu").lower()
+SAVE_DEBUG_IMAGE = os.getenv("SAVE_DEBUG_IMAGE") == "1"
+_CPU_COUNT = os.cpu_count() or 1
+# ว่าง, 0 หรือติดลบ = ใช้ทุก core (ค่าเดียวกันนี้ส่งให้ SessionOptions ด้วย)
+ORT_INTRA_OP_THREADS = int(os.getenv("ORT_INTRA_OP_THREADS") or 0)
+if ORT_INTRA_OP_THREADS <= 0:
+    ORT_INTRA_OP_THREADS = _CPU_COUNT
+
+# Each session.run already fans out over ORT_INTRA_OP_THREADS cores; letting more
+# requests into ONNX Runtime than the cores can hold only makes them thrash
+_inference_slots = threading.BoundedSemaphore(max(1, _CPU_COUNT // ORT_INTRA_OP_THREADS))
 
 _face_app = None
+_face_app_lock = threading.Lock()
 
 def get_face_app():
     global _face_app
     if _face_app is None:
-        # ✅ lazy import: ไม่ import insightface ตอนเริ่มแอป
-        from insightface.app import FaceAnalysis
-
-        print("⏳ Lazy loading ArcFace model to memory...")
-        _face_app = FaceAnalysis(
-            name="buffalo_sc",  # หรือ buffalo_sc ถ้าจะเล็กกว่า
-            providers=["CPUExecutionProvider"]
-        )
-        # ✅ CPU ต้อง ctx_id=-1
-        _face_app.prepare(ctx_id=-1, det_size=(320, 320))
-        print("✅ FaceService initialized with ArcFace model")
+        # หลาย request (thread) อาจเรียกพร้อมกันครั้งแรก: โหลด model แค่ครั้งเดียว
+        with _face_app_lock:
+            if _face_app is None:
+                # ✅ lazy import: ไม่ import insightface ตอนเริ่มแอป
+                import onnxruntime as ort
+                from insightface.app import FaceAnalysis
+
+                # FaceAnalysis ไม่ส่ง SessionOptions ต่อให้ model (ส่งแค่ providers)
+                # จึงสร้าง session ใหม่ด้วย options นี้หลัง prepare()
+                sess_options = ort.SessionOptions()
+                sess_options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+                sess_options.intra_op_num_threads = ORT_INTRA_OP_THREADS
+                sess_options.inter_op_num_threads = 1
+
+                if FACE_PROVIDER == "cuda":
+                    # ต้องติดตั้ง onnxruntime-gpu ที่ตรงกับเวอร์ชัน CUDA/cuDNN ของเครื่อง
+                    providers = [
+                        ("CUDAExecutionProvider", {"cudnn_conv_algo_search": "EXHAUSTIVE"}),
+                        "CPUExecutionProvider",
+                    ]
+                    ctx_id = 0
+                else:
+                    providers = ["CPUExecutionProvider"]
+                    ctx_id = -1  # ✅ CPU ต้อง ctx_id=-1
+
+                print(f"⏳ Lazy loading ArcFace model {FACE_MODEL} to memory ({FACE_PROVIDER})...")
+                app = FaceAnalysis(name=FACE_MODEL, providers=providers)
+                app.prepare(ctx_id=ctx_id, det_size=(320, 320))
+                for model in app.models.values():
+                    model.session = ort.InferenceSession(
+                        model.model_file, sess_options=sess_options, providers=providers
+                    )
+                _face_app = app  # publish only once fully prepared
+                print("✅ FaceService initialized with ArcFace model")
     return _face_app
 
 
+def _image_cache_key(image_base64: str) -> str:
+    xxhash = optional_import("xxhash")
+    if xxhash is not None:
+        return xxhash.xxh3_64_hexdigest(image_base64)
+    return hashlib.blake2b(image_base64.encode(), digest_size=16).hexdigest()
+
+
+class _EmbeddingCache:
+    """Thread-safe bounded LRU of image hash -> embedding"""
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._items: "OrderedDict[str, np.ndarray]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[np.ndarray]:
+        with self._lock:
+            embedding = self._items.get(key)
+            if embedding is not None:
+                self._items.move_to_end(key)
+            return embedding
+
+    def put(self, key: str, embedding: np.ndarray):
+        embedding = embedding.copy()
+        embedding.setflags(write=False)
+        with self._lock:
+            self._items[key] = embedding
+            self._items.move_to_end(key)
+            while len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
+
+
 class FaceService:
     def __init__(self):
+        self._embedding_cache = _EmbeddingCache(EMBEDDING_CACHE_SIZE)
         print("✅ FaceService struct initialized (model will be loaded on demand)")
 
+    def warmup(self):
+        """
+        Load the model and run one dummy detect + embed so the first request hits hot kernels
+        (on CUDA this also triggers the cuDNN algorithm search and GPU allocator warm-up)
+        """
+        app = get_face_app()
+        app.get(np.zeros((480, 640, 3), dtype=np.uint8))
+        # a blank frame has no face, so exercise the recognition session directly
+        app.models["recognition"].get_feat(np.zeros((112, 112, 3), dtype=np.uint8))
+        print("🔥 ArcFace model warmed up")
+
     def decode_base64_image(self, image_base64: str) -> np.ndarray:
         if "," in image_base64:
             image_base64 = image_base64.split(",")[1]
@@ -42,29 +136,33 @@ class FaceService:
 
     def detect_faces(self, image: np.ndarray) -> list:
         app = get_face_app()
-        return app.get(image)
+        with _inference_slots:
+            return app.get(image)
 
-    def get_single_face_embedding(self, image_base64: str) -> Tuple[Optional[List[float]], str]:
-        try:
-            image = self.decode_base64_image(image_base64)
-            h, w = image.shape[:2]
-            print(f"📐 Image decoded: {w}×{h}px")
-
-            # ✅ debug เฉพาะตอนอยากเก็บจริง ๆ
-            if os.getenv("SAVE_DEBUG_IMAGE") == "1":
-                cv2.imwrite("/tmp/debug_received_image.jpg", image)
-                print("Saved debug image to /tmp/debug_received_image.jpg")
-
-            # ✅ pad แค่ให้พอ (ไม่บังคับ 640)
-            target = max(320, h, w)
-            if h < target or w < target:
-                padded = np.zeros((target, target, 3), dtype=np.uint8)
-                y_offset = (target - h) // 2
-                x_offset = (target - w) // 2
-                padded[y_offset:y_offset+h, x_offset:x_offset+w] = image
-                image = padded
-                print(f"📐 Padded to: {target}×{target}px")
+    def prepare_image(self, image: np.ndarray) -> np.ndarray:
+        h, w = image.shape[:2]
+
+        # ✅ debug เฉพาะตอนอยากเก็บจริง ๆ (ชื่อไฟล์ไม่ชนกันระหว่าง worker/thread)
+        if SAVE_DEBUG_IMAGE:
+            debug_path = f"/tmp/debug_received_image_{os.getpid()}_{time.time_ns()}.jpg"
+            cv2.imwrite(debug_path, image)
 
+        # ย่อภาพใหญ่ (เช่นจากมือถือ 4000×3000) ก่อน detect: ความละเอียดเกินนี้ไม่ช่วยความแม่นยำ
+        scale = min(1.0, MAX_IMAGE_SIDE / max(h, w))
+        if scale < 1.0:
+            image = cv2.resize(image, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+
+        # ไม่ต้อง pad เอง: detector ของ InsightFace letterbox ภาพเข้า det_size (320×320) ให้อยู่แล้ว
+        return image
+
+    def get_single_face_embedding(self, image_base64: str) -> Tuple[Optional[np.ndarray], str]:
+        key = _image_cache_key(image_base64)
+        cached = self._embedding_cache.get(key)
+        if cached is not None:
+            return cached, "Success"
+
+        try:
+            image = self.prepare_image(self.decode_base64_image(image_base64))
             faces = self.detect_faces(image)
 
             if len(faces) == 0:
@@ -72,32 +170,105 @@ class FaceService:
             if len(faces) > 1:
                 return None, f"Multiple faces detected ({len(faces)}). Please ensure only one face is visible"
 
-            embedding = faces[0].embedding.tolist()
+            embedding = faces[0].normed_embedding.astype(np.float32)
+            self._embedding_cache.put(key, embedding)
             return embedding, "Success"
 
         except Exception as e:
             return None, str(e)
 
-    def get_multiple_face_embeddings(self, images_base64: List[str]) -> Tuple[Optional[List[List[float]]], str]:
-        embeddings = []
-        for i, img_b64 in enumerate(images_base64):
-            emb, status = self.get_single_face_embedding(img_b64)
-            if emb is None:
-                return None, f"Image {i + 1}: {status}"
-            embeddings.append(emb)
-        return embeddings, "Success"
-
-    def compute_cosine_similarity(self, embedding1: List[float], embedding2: List[float]) -> float:
-        v1 = np.asarray(embedding1, dtype=np.float32)
-        v2 = np.asarray(embedding2, dtype=np.float32)
-        v1 /= (np.linalg.norm(v1) + 1e-8)
-        v2 /= (np.linalg.norm(v2) + 1e-8)
-        return float(np.dot(v1, v2))
+    def _align_face(self, image: np.ndarray) -> Tuple[Optional[np.ndarray], str]:
+        """Detect exactly one face and return its aligned ArcFace input crop"""
+        from insightface.utils import face_align
+
+        app = get_face_app()
+        with _inference_slots:
+            _, kpss = app.det_model.detect(image, max_num=0, metric="default")
+        n_faces = 0 if kpss is None else len(kpss)
+        if n_faces == 0:
+            return None, "No face detected in the image"
+        if n_faces > 1:
+            return None, f"Multiple faces detected ({n_faces}). Please ensure only one face is visible"
+        image_size = app.models["recognition"].input_size[0]
+        return face_align.norm_crop(image, landmark=kpss[0], image_size=image_size), "Success"
+
+    def _embed_crops(self, crops: List[np.ndarray]) -> np.ndarray:
+        # get_feat stacks the crops into one (B, 3, 112, 112) blob
+        rec = get_face_app().models["recognition"]
+        with _inference_slots:
+            embeddings = rec.get_feat(crops).astype(np.float32)
+        embeddings /= (np.linalg.norm(embeddings, axis=1, keepdims=True) + 1e-8)
+        return embeddings
+
+    def get_face_embeddings_batch(
+        self,
+        images: List[np.ndarray],
+        image_numbers: Optional[List[int]] = None
+    ) -> Tuple[Optional[np.ndarray], str]:
+        """
+        Detect one face per image, then embed all aligned 112×112 crops
+        with a single ArcFace session.run.
+        
+        image_numbers labels the images in error messages (default 1..B).
+        
+        Returns:
+            ((B, 512) L2-normalized embeddings, "Success") or (None, error message)
+        """
+        if image_numbers is None:
+            image_numbers = list(range(1, len(images) + 1))
+
+        crops = []
+        for number, image in zip(image_numbers, images):
+            crop, status = self._align_face(image)
+            if crop is None:
+                return None, f"Image {number}: {status}"
+            crops.append(crop)
+        return self._embed_crops(crops), "Success"
+
+    def _decode_and_prepare(self, image_base64: str) -> Tuple[Optional[np.ndarray], str]:
+        try:
+            return self.prepare_image(self.decode_base64_image(image_base64)), "Success"
+        except Exception as e:
+            return None, str(e)
+
+    def get_multiple_face_embeddings(self, images_base64: List[str]) -> Tuple[Optional[np.ndarray], str]:
+        if not images_base64:
+            return None, "No images provided"
+
+        # Retries / repeated frames hit the cache and skip decode + inference entirely
+        keys = [_image_cache_key(img_b64) for img_b64 in images_base64]
+        embeddings = [self._embedding_cache.get(key) for key in keys]
+        missing = [i for i, emb in enumerate(embeddings) if emb is None]
+
+        if missing:
+            # b64decode and cv2.imdecode release the GIL, so threads decode in parallel
+            max_workers = max(1, min(DECODE_WORKERS, len(missing)))
+            with ThreadPoolExecutor(max_workers=max_workers) as ex:
+                decoded = list(ex.map(self._decode_and_prepare, [images_base64[i] for i in missing]))
+
+            images = []
+            for i, (image, status) in zip(missing, decoded):
+                if image is None:
+                    return None, f"Image {i + 1}: {status}"
+                images.append(image)
+
+            try:
+                batch, status = self.get_face_embeddings_batch(images, [i + 1 for i in missing])
+            except Exception as e:
+                return None, str(e)
+            if batch is None:
+                return None, status
+
+            for i, emb in zip(missing, batch):
+                self._embedding_cache.put(keys[i], emb)
+                embeddings[i] = emb
+
+        return np.stack(embeddings), "Success"
 
     def find_best_match(
         self,
-        query_embeddings: List[List[float]],
-        stored_faces: List[dict],
+        query_embeddings: np.ndarray,
+        gallery: "EmbeddingGallery",
         threshold: float
     ) -> Tuple[bool, Optional[str], Optional[str], float, str]:
         """
@@ -108,34 +279,21 @@ class FaceService:
         """
         IMAGE_LABELS = ["หันขวา", "หันซ้าย", "หน้าตรง"]
 
-        if not stored_faces or not query_embeddings:
+        if not len(gallery) or not len(query_embeddings):
             return False, None, None, 0.0, "ไม่มีใบหน้าที่ลงทะเบียนในระบบ"
 
         # Step 1: For each query image, find its best matching user
+        # Query rows come L2-normalized from extraction and gallery rows at load,
+        # so the inner product is already the cosine similarity
+        q = np.asarray(query_embeddings, dtype=np.float32)
+
+        best_idx, best_scores = gallery.search(q)
+
         per_image_best = []
-        
-        for qi, q_emb in enumerate(query_embeddings):
-            best_user_id = None
-            best_name = None
-            best_score = -1.0
-            
-            for face in stored_faces:
-                stored_embeddings = face.get("embeddings", [])
-                if not stored_embeddings and "embedding" in face:
-                    stored_embeddings = [face["embedding"]]
-                if not stored_embeddings:
-                    continue
-                
-                for s_emb in stored_embeddings:
-                    score = self.compute_cosine_similarity(q_emb, s_emb)
-                    if score > best_score:
-                        best_score = score
-                        best_user_id = face["user_id"]
-                        best_name = face["name"]
-            
-            label = IMAGE_LABELS[qi] if qi < len(IMAGE_LABELS) else f"Image {qi+1}"
-            print(f"  📸 {label}: best match = '{best_name}' (score={best_score:.4f})")
-            per_image_best.append((best_user_id, best_name, best_score))
+        for ui, best_score in zip(best_idx, best_scores):
+            user = gallery.users[ui]
+            best_user_id, best_name = user["user_id"], user["name"]
+            per_image_best.append((best_user_id, best_name, float(best_score)))
 
         # Step 2: Check if all images agree on the same user
         matched_user_ids = set(uid for uid, _, _ in per_image_best if uid is not None)
@@ -1,6 +1,7 @@
 """
 Face Recognition API - FastAPI Backend
 """
+import asyncio
 import os
 from typing import Optional, List
 from contextlib import asynccontextmanager
@@ -10,26 +11,29 @@ from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 from dotenv import load_dotenv
 
-from storage import FaceStorage
-from face_service import get_face_service
-
-# Load environment variables
+# Load environment variables (before importing modules that read them at import time)
 load_dotenv()
 
+from storage import FaceStorage
+from face_service import FACE_MODEL, get_face_service
+
 # Configuration
 MATCH_THRESHOLD = float(os.getenv("MATCH_THRESHOLD", "0.45"))
+FACE_WARMUP = os.getenv("FACE_WARMUP", "1") == "1"
 DATA_DIR = os.path.dirname(os.path.abspath(__file__))
-FACES_FILE = os.path.join(DATA_DIR, "faces.json")
+FACES_FILE = os.path.join(DATA_DIR, "faces.db")
 
 
 # Lifespan context manager for startup/shutdown
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    # Startup: Initialize face service (loads model)
+    # Startup: Initialize face service (loads + warms up model unless FACE_WARMUP=0)
     print("🚀 Starting Face Recognition API...")
     print(f"📁 Faces file: {FACES_FILE}")
     print(f"🎯 Match threshold: {MATCH_THRESHOLD}")
-    get_face_service()  # Initialize on startup
+    face_service = get_face_service()  # Initialize on startup
+    if FACE_WARMUP:
+        await asyncio.to_thread(face_service.warmup)
     yield
     # Shutdown
     print("👋 Shutting down Face Recognition API...")
@@ -53,7 +57,7 @@ app.add_middleware(
 )
 
 # Initialize storage
-storage = FaceStorage(FACES_FILE)
+storage = FaceStorage(FACES_FILE, model_name=FACE_MODEL)
 
 
 # ===== Request/Response Models =====
@@ -121,7 +125,7 @@ async def register_face(request: RegisterRequest):
     
     - Detects exactly one face in the image
     - Extracts 512-dim ArcFace embedding
-    - Stores in JSON file
+    - Stores embeddings in SQLite (float32 BLOBs)
     """
     face_service = get_face_service()
     
@@ -134,7 +138,7 @@ async def register_face(request: RegisterRequest):
         raise HTTPException(status_code=400, detail="images_base64 cannot be empty")
     
     # Check if user already exists
-    existing = storage.get_face_by_id(request.user_id)
+    existing = await asyncio.to_thread(storage.get_face_by_id, request.user_id)
     if existing:
         raise HTTPException(
             status_code=409, 
@@ -142,14 +146,18 @@ async def register_face(request: RegisterRequest):
         )
     
     # Extract embeddings for all images
-    embeddings, status = face_service.get_multiple_face_embeddings(request.images_base64)
+    # Decode + detect + embed is blocking; keep it off the event loop
+    embeddings, status = await asyncio.to_thread(
+        face_service.get_multiple_face_embeddings, request.images_base64
+    )
     
     if embeddings is None:
         print(f"❌ Registration failed for user {request.user_id}: {status}")
         raise HTTPException(status_code=400, detail=status)
     
-    # Store in JSON
-    success = storage.add_face(
+    # Store embeddings
+    success = await asyncio.to_thread(
+        storage.add_face,
         user_id=request.user_id.strip(),
         name=request.name.strip(),
         embeddings=embeddings
@@ -181,7 +189,9 @@ async def verify_face(request: VerifyRequest):
         raise HTTPException(status_code=400, detail="images_base64 cannot be empty")
     
     # Extract embeddings for all images
-    query_embeddings, status = face_service.get_multiple_face_embeddings(request.images_base64)
+    query_embeddings, status = await asyncio.to_thread(
+        face_service.get_multiple_face_embeddings, request.images_base64
+    )
     
     if query_embeddings is None:
         return VerifyResponse(
@@ -191,9 +201,9 @@ async def verify_face(request: VerifyRequest):
         )
     
     # Get all stored faces
-    stored_faces = storage.get_all_embeddings()
+    gallery = await asyncio.to_thread(storage.get_embedding_matrix)
     
-    if not stored_faces:
+    if not len(gallery):
         return VerifyResponse(
             matched=False,
             score=0.0,
@@ -201,9 +211,10 @@ async def verify_face(request: VerifyRequest):
         )
     
     # Find best match using all query embeddings
-    matched, user_id, name, score, reason = face_service.find_best_match(
+    matched, user_id, name, score, reason = await asyncio.to_thread(
+        face_service.find_best_match,
         query_embeddings,
-        stored_faces,
+        gallery,
         MATCH_THRESHOLD
     )
     
@@ -226,7 +237,7 @@ async def verify_face(request: VerifyRequest):
 @app.get("/users", response_model=UsersResponse)
 async def list_users():
     """List all registered users (without embeddings)"""
-    users = storage.get_all_faces()
+    users = await asyncio.to_thread(storage.get_all_faces)
     return UsersResponse(
         count=len(users),
         users=[UserInfo(**u) for u in users]
@@ -236,7 +247,7 @@ async def list_users():
 @app.delete("/users/{user_id}", response_model=DeleteResponse)
 async def delete_user(user_id: str):
     """Delete a registered user"""
-    success = storage.delete_face(user_id)
+    success = await asyncio.to_thread(storage.delete_face, user_id)
     
     if not success:
         raise HTTPException(
@@ -255,12 +266,18 @@ async def health_check():
     """Detailed health check"""
     return {
         "status": "healthy",
-        "registered_faces": storage.count(),
+        "registered_faces": await asyncio.to_thread(storage.count),
         "threshold": MATCH_THRESHOLD,
-        "model": "ArcFace (buffalo_l)"
+        "model": f"ArcFace ({FACE_MODEL})"
     }
 
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    # Multiple workers need the import string; size ORT_INTRA_OP_THREADS to cores / workers
+    uvicorn.run(
+        "main:app",
+        host="0.0.0.0",
+        port=8000,
+        workers=int(os.getenv("WEB_CONCURRENCY", "1"))
+    )
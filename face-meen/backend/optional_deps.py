@@ -0,0 +1,15 @@
+"""
+Optional accelerator imports shared by storage and face_service
+Each package is imported on first use; a missing one falls back to NumPy / hashlib
+"""
+import importlib
+from functools import lru_cache
+
+
+@lru_cache(maxsize=None)
+def optional_import(module_name: str):
+    """Import an optional accelerator (faiss, simsimd, numba, xxhash) on demand; None if not installed"""
+    try:
+        return importlib.import_module(module_name)
+    except ImportError:
+        return None
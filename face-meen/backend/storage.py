@@ -1,129 +1,500 @@
 """
-JSON Storage Utility for Face Embeddings
-With thread-based locking to prevent concurrent write corruption
+SQLite Storage Utility for Face Embeddings
+Embeddings are stored as raw float32 BLOBs; SQLite (WAL) handles concurrency
 """
 import json
 import os
+import sqlite3
 import threading
 from datetime import datetime
+from functools import lru_cache
+from itertools import groupby
 from typing import Optional, List, Dict, Any
 from pathlib import Path
 
+import numpy as np
+
+from optional_deps import optional_import
+
+EMBEDDING_DIM = 512
+
+# Above this many stored rows switch from exact FlatIP to approximate HNSW search
+HNSW_MIN_ROWS = 10_000
+HNSW_M = 32
+HNSW_EF_SEARCH_FAST = 16
+HNSW_EF_SEARCH = 64
+
+# Above this many stored rows the FAISS index keeps 8-bit scalar-quantized codes
+# (4x less memory traffic per scan); the top RESCORE_K hits are rescored in float32
+SQ8_MIN_ROWS = 2_000
+RESCORE_K = 8
+
+# A query scoring at least this against some user is a certain match (threshold
+# is ~0.45), so the scan stops there; the non-FAISS scan goes SCAN_BLOCK_ROWS at a time
+EARLY_EXIT_THRESHOLD = float(os.getenv("EARLY_EXIT_THRESHOLD", "0.85"))
+SCAN_BLOCK_ROWS = 4096
+
+
+# Bound to numba.prange when the kernel below gets compiled
+_prange = range
+
+
+def _best_match_scan(queries, matrix, user_slices):
+    """Best (user, score) per query; users scanned in parallel, rows [start, end) each"""
+    n_queries = queries.shape[0]
+    n_users = user_slices.shape[0]
+    dim = matrix.shape[1]
+
+    per_user = np.full((n_queries, n_users), -np.inf, dtype=np.float32)
+    for u in _prange(n_users):
+        for r in range(user_slices[u, 0], user_slices[u, 1]):
+            for q in range(n_queries):
+                score = np.float32(0.0)
+                for k in range(dim):
+                    score += queries[q, k] * matrix[r, k]
+                if score > per_user[q, u]:
+                    per_user[q, u] = score
+
+    best_users = np.zeros(n_queries, dtype=np.int32)
+    best_scores = np.full(n_queries, -np.inf, dtype=np.float32)
+    for q in range(n_queries):
+        for u in range(n_users):
+            if per_user[q, u] > best_scores[q]:
+                best_scores[q] = per_user[q, u]
+                best_users[q] = u
+    return best_users, best_scores
+
+
+@lru_cache(maxsize=None)
+def _best_match_kernel():
+    """JIT-compile _best_match_scan on first use, so numba stays off the startup path (None if not installed)"""
+    global _prange
+    numba = optional_import("numba")
+    if numba is None:
+        return None
+    _prange = numba.prange
+    return numba.njit(cache=True, fastmath=True, parallel=True)(_best_match_scan)
+
+
+class EmbeddingGallery:
+    """
+    All live stored embeddings stacked into one L2-normalized (S, 512) float32 matrix.
+    Rows of users[i] are matrix[offsets[i]:offsets[i + 1]]
+    """
+    def __init__(self, items: List[Dict[str, Any]]):
+        self.users: List[Dict[str, str]] = []
+        blocks: List[np.ndarray] = []
+        offsets: List[int] = []
+        n_rows = 0
+
+        for item in items:
+            embeddings = item.get("embeddings", [])
+            if not len(embeddings) and "embedding" in item:
+                embeddings = [item["embedding"]]
+            if not len(embeddings):
+                continue
+
+            block = np.asarray(embeddings, dtype=np.float32).reshape(-1, EMBEDDING_DIM)
+            offsets.append(n_rows)
+            n_rows += len(block)
+            blocks.append(block)
+            self.users.append({"user_id": item["user_id"], "name": item["name"]})
+
+        if blocks:
+            # concatenate copies out of the read-only frombuffer views before normalizing in place
+            matrix = np.ascontiguousarray(np.concatenate(blocks), dtype=np.float32)
+            # Once per load; also covers raw (unnormalized) rows imported from older stores
+            matrix /= (np.linalg.norm(matrix, axis=1, keepdims=True) + 1e-8)
+        else:
+            matrix = np.empty((0, EMBEDDING_DIM), dtype=np.float32)
+
+        self.matrix = matrix
+        self.offsets = np.asarray(offsets, dtype=np.intp)
+        ends = np.asarray(offsets[1:] + [n_rows] if offsets else [], dtype=np.intp)
+        self.row_to_user = np.repeat(np.arange(len(offsets), dtype=np.intp), ends - self.offsets)
+        self.user_slices = np.ascontiguousarray(np.stack([self.offsets, ends], axis=1), dtype=np.int32)
+        self._index = None
+        self._index_lock = threading.Lock()
+        self._quantized = False
+        self._is_hnsw = False
+
+    def __len__(self) -> int:
+        return len(self.users)
+
+    def build_index(self):
+        """Build the FAISS index now, so the first search doesn't pay for training + add"""
+        self._get_index()
+
+    def _get_index(self):
+        """Build the FAISS index once (None if faiss is unavailable)"""
+        if self._index is not None:
+            return self._index or None
+        with self._index_lock:
+            if self._index is None:
+                self._build_index()
+        return self._index or None
+
+    def _build_index(self):
+        faiss = optional_import("faiss")
+        if faiss is None:
+            self._index = False
+            return
+
+        dim = self.matrix.shape[1]
+        n_rows = len(self.matrix)
+        quantize = n_rows >= SQ8_MIN_ROWS
+        if n_rows >= HNSW_MIN_ROWS:
+            if quantize:
+                index = faiss.IndexHNSWSQ(
+                    dim, faiss.ScalarQuantizer.QT_8bit, HNSW_M, faiss.METRIC_INNER_PRODUCT
+                )
+            else:
+                index = faiss.IndexHNSWFlat(dim, HNSW_M, faiss.METRIC_INNER_PRODUCT)
+        elif quantize:
+            index = faiss.IndexScalarQuantizer(
+                dim, faiss.ScalarQuantizer.QT_8bit, faiss.METRIC_INNER_PRODUCT
+            )
+        else:
+            index = faiss.IndexFlatIP(dim)
+        if quantize:
+            index.train(self.matrix)
+        index.add(self.matrix)
+        self._quantized = quantize
+        self._is_hnsw = n_rows >= HNSW_MIN_ROWS
+        # Published last: _get_index's unlocked fast path reads this
+        self._index = index
+
+    def _search_index(self, index, queries: np.ndarray, params=None):
+        if not self._quantized:
+            scores, rows = index.search(queries, 1, params=params)
+            return self.row_to_user[rows[:, 0]], scores[:, 0]
+
+        # int8 scores are approximate: rescore the shortlist against the float32 rows
+        _, rows = index.search(queries, min(RESCORE_K, len(self.matrix)), params=params)
+        scores = np.einsum("qd,qkd->qk", queries, self.matrix[rows])
+        scores[rows < 0] = -np.inf
+        best = scores.argmax(axis=1)
+        picked = np.arange(len(queries))
+        return self.row_to_user[rows[picked, best]], scores[picked, best]
+
+    def _score_block(self, queries: np.ndarray, user_start: int, user_end: int):
+        """Best (user, score) per query among users [user_start, user_end)"""
+        row_start = self.offsets[user_start]
+        row_end = self.offsets[user_end] if user_end < len(self.users) else len(self.matrix)
+        block = self.matrix[row_start:row_end]
+
+        kernel = _best_match_kernel()
+        if kernel is not None:
+            slices = (self.user_slices[user_start:user_end] - row_start).astype(np.int32)
+            best_idx, best_scores = kernel(queries, block, slices)
+            return user_start + best_idx, best_scores
+
+        simsimd = optional_import("simsimd")
+        if simsimd is not None:
+            distances = simsimd.cdist(queries, block, metric="cosine")
+            sims = 1.0 - np.asarray(distances, dtype=np.float32)     # (Q, rows)
+        else:
+            sims = queries @ block.T                                  # (Q, rows)
+        per_user = np.maximum.reduceat(sims, self.offsets[user_start:user_end] - row_start, axis=1)
+        best_idx = per_user.argmax(axis=1)
+        return user_start + best_idx, per_user[np.arange(len(queries)), best_idx]
+
+    def search(self, queries: np.ndarray):
+        """
+        Find the best matching user for each normalized query row.
+        Stops early once every query already has a match >= EARLY_EXIT_THRESHOLD,
+        so the returned user is then a certain match but not necessarily the top one.
+
+        Returns:
+            (user_indices, scores) - one entry per query
+        """
+        queries = np.ascontiguousarray(queries, dtype=np.float32)
+
+        index = self._get_index()
+        if index is not None:
+            if not self._is_hnsw:
+                return self._search_index(index, queries)
+
+            # Cheap graph walk first; widen it only if the match isn't certain
+            faiss = optional_import("faiss")
+            result = self._search_index(
+                index, queries, faiss.SearchParametersHNSW(efSearch=HNSW_EF_SEARCH_FAST)
+            )
+            if (result[1] >= EARLY_EXIT_THRESHOLD).all():
+                return result
+            return self._search_index(
+                index, queries, faiss.SearchParametersHNSW(efSearch=HNSW_EF_SEARCH)
+            )
+
+        best_users = np.zeros(len(queries), dtype=np.intp)
+        best_scores = np.full(len(queries), -np.inf, dtype=np.float32)
+        n_users = len(self.users)
+        user_start = 0
+        while user_start < n_users:
+            # Block = users whose rows start within the next SCAN_BLOCK_ROWS rows
+            block_end_row = self.offsets[user_start] + SCAN_BLOCK_ROWS
+            user_end = max(user_start + 1, int(np.searchsorted(self.offsets, block_end_row)))
+
+            users, scores = self._score_block(queries, user_start, user_end)
+            better = scores > best_scores
+            best_users[better] = users[better]
+            best_scores[better] = scores[better]
+
+            if (best_scores >= EARLY_EXIT_THRESHOLD).all():
+                break
+            user_start = user_end
+        return best_users, best_scores
+
 
 class FaceStorage:
-    def __init__(self, file_path: str = "faces.json"):
-        self.file_path = Path(file_path)
-        self._lock = threading.Lock()
-        self._ensure_file_exists()
-    
-    def _ensure_file_exists(self):
-        """Create the JSON file if it doesn't exist"""
-        if not self.file_path.exists():
-            self._write_data({
-                "version": "1.0",
-                "model": "arcface",
-                "items": []
-            })
+    """
+    SQLite-backed face store (WAL mode): one row per user in `faces`,
+    one float32 BLOB per embedding in `embeddings`. SQLite handles
+    concurrent readers/writers across threads and worker processes.
+    """
+    def __init__(self, db_path: str = "faces.db", model_name: Optional[str] = None):
+        self.db_path = Path(db_path)
+        # Recorded with the first face; embeddings from different models aren't comparable
+        self.model_name = model_name
+        self._local = threading.local()
+        # Matching cache; rebuilt when the store's version counter moves
+        self._cache_lock = threading.Lock()
+        self._gallery: Optional[EmbeddingGallery] = None
+        self._cache_version = -1
+        self._ensure_schema()
+        self._check_model()
+    
+    def _connect(self) -> sqlite3.Connection:
+        """One connection per thread (sqlite3 connections aren't shareable across threads)"""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+    
+    def _ensure_schema(self):
+        """Create tables if needed (importing a legacy faces.json once)"""
+        conn = self._connect()
+        with conn:
+            conn.executescript("""
+                CREATE TABLE IF NOT EXISTS faces (
+                    user_id TEXT PRIMARY KEY,
+                    name TEXT NOT NULL,
+                    created_at TEXT NOT NULL,
+                    updated_at TEXT
+                );
+                CREATE TABLE IF NOT EXISTS embeddings (
+                    user_id TEXT NOT NULL,
+                    idx INTEGER NOT NULL,
+                    vec BLOB NOT NULL,
+                    PRIMARY KEY (user_id, idx)
+                );
+                CREATE TABLE IF NOT EXISTS meta (
+                    key TEXT PRIMARY KEY,
+                    value INTEGER NOT NULL
+                );
+                INSERT OR IGNORE INTO meta (key, value) VALUES ('version', 0);
+            """)
+        self._import_legacy_json()
     
-    def _read_data(self) -> Dict[str, Any]:
-        """Read data from JSON file (thread-safe)"""
-        with self._lock:
-            with open(self.file_path, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-        return data
-    
-    def _write_data(self, data: Dict[str, Any]):
-        """Write data to JSON file (thread-safe, atomic write)"""
-        with self._lock:
-            temp_path = self.file_path.with_suffix('.tmp')
+    def _import_legacy_json(self):
+        """
+        Import a legacy faces.json next to the database, once per database.
+        The 'json_imported' meta flag is written in the same transaction, so
+        deleting every user later doesn't bring the file's faces back.
+        """
+        legacy_path = self.db_path.with_name("faces.json")
+        conn = self._connect()
+        with conn:
+            # IMMEDIATE: only one worker process gets to check + import
+            conn.execute("BEGIN IMMEDIATE")
+            if conn.execute("SELECT 1 FROM meta WHERE key = 'json_imported'").fetchone():
+                return
+            conn.execute("INSERT INTO meta (key, value) VALUES ('json_imported', 1)")
             
-            with open(temp_path, 'w', encoding='utf-8') as f:
-                json.dump(data, f, indent=2, ensure_ascii=False)
+            has_faces = conn.execute("SELECT 1 FROM faces LIMIT 1").fetchone()
+            if has_faces or not legacy_path.exists():
+                return
             
-            # Atomic replace
-            os.replace(temp_path, self.file_path)
+            with open(legacy_path, 'r', encoding='utf-8') as f:
+                items = json.load(f)["items"]
+            for item in items:
+                embeddings = item.get("embeddings", [])
+                if not embeddings and "embedding" in item:
+                    embeddings = [item["embedding"]]
+                cur = conn.execute(
+                    "INSERT OR IGNORE INTO faces (user_id, name, created_at, updated_at) VALUES (?, ?, ?, ?)",
+                    (item["user_id"], item["name"], item["created_at"], item.get("updated_at"))
+                )
+                # Duplicate user_id in the file: first entry wins, same as for faces
+                if cur.rowcount == 0:
+                    continue
+                self._insert_embeddings(conn, item["user_id"], embeddings)
+            self._bump_version(conn)
+    
+    def _check_model(self):
+        """Refuse to open a store whose faces were enrolled with a different model"""
+        if self.model_name is None:
+            return
+        conn = self._connect()
+        row = conn.execute("SELECT value FROM meta WHERE key = 'model'").fetchone()
+        if row is None or row[0] == self.model_name:
+            return
+        if conn.execute("SELECT 1 FROM faces LIMIT 1").fetchone():
+            raise RuntimeError(
+                f"{self.db_path} holds embeddings from model '{row[0]}', but the service "
+                f"is configured for '{self.model_name}'. Set FACE_MODEL={row[0]} or "
+                f"re-register every face with the new model."
+            )
+        # Store is empty: nothing to mix up, the next face records the new model
+        with conn:
+            conn.execute("DELETE FROM meta WHERE key = 'model'")
+    
+    def _record_model(self, conn: sqlite3.Connection):
+        """Remember which model produced the stored embeddings (call inside the write transaction)"""
+        if self.model_name is not None:
+            conn.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('model', ?)", (self.model_name,))
+    
+    def _insert_embeddings(self, conn: sqlite3.Connection, user_id: str, embeddings: np.ndarray):
+        rows = np.ascontiguousarray(embeddings, dtype="<f4").reshape(-1, EMBEDDING_DIM)
+        conn.executemany(
+            "INSERT INTO embeddings (user_id, idx, vec) VALUES (?, ?, ?)",
+            [(user_id, i, row.tobytes()) for i, row in enumerate(rows)]
+        )
+    
+    def _bump_version(self, conn: sqlite3.Connection):
+        """Mark the gallery stale for every thread/process (call inside the write transaction)"""
+        conn.execute("UPDATE meta SET value = value + 1 WHERE key = 'version'")
+    
+    def _read_version(self) -> int:
+        return self._connect().execute("SELECT value FROM meta WHERE key = 'version'").fetchone()[0]
+    
+    def _decode_embeddings(self, blobs: List[bytes]) -> np.ndarray:
+        return np.frombuffer(b"".join(blobs), dtype="<f4").reshape(-1, EMBEDDING_DIM)
     
-    def add_face(self, user_id: str, name: str, embeddings: List[List[float]]) -> bool:
+    def add_face(self, user_id: str, name: str, embeddings: np.ndarray) -> bool:
         """
         Add a new face to storage
         Returns False if user_id already exists
         """
-        data = self._read_data()
-        
-        # Check if user_id already exists
-        for item in data["items"]:
-            if item["user_id"] == user_id:
-                return False
-        
-        # Add new entry
-        data["items"].append({
-            "user_id": user_id,
-            "name": name,
-            "embeddings": embeddings,
-            "created_at": datetime.now().astimezone().isoformat()
-        })
-        
-        self._write_data(data)
+        conn = self._connect()
+        try:
+            with conn:
+                conn.execute(
+                    "INSERT INTO faces (user_id, name, created_at) VALUES (?, ?, ?)",
+                    (user_id, name, datetime.now().astimezone().isoformat())
+                )
+                self._insert_embeddings(conn, user_id, embeddings)
+                self._record_model(conn)
+                self._bump_version(conn)
+        except sqlite3.IntegrityError:
+            return False
         return True
     
-    def update_face(self, user_id: str, name: str, embeddings: List[List[float]]) -> bool:
+    def update_face(self, user_id: str, name: str, embeddings: np.ndarray) -> bool:
         """
         Update an existing face in storage
         Returns False if user_id doesn't exist
         """
-        data = self._read_data()
-        
-        for item in data["items"]:
-            if item["user_id"] == user_id:
-                item["name"] = name
-                item["embeddings"] = embeddings
-                item["updated_at"] = datetime.now().astimezone().isoformat()
-                self._write_data(data)
-                return True
-        
-        return False
+        conn = self._connect()
+        with conn:
+            cur = conn.execute(
+                "UPDATE faces SET name = ?, updated_at = ? WHERE user_id = ?",
+                (name, datetime.now().astimezone().isoformat(), user_id)
+            )
+            if cur.rowcount == 0:
+                return False
+            conn.execute("DELETE FROM embeddings WHERE user_id = ?", (user_id,))
+            self._insert_embeddings(conn, user_id, embeddings)
+            self._record_model(conn)
+            self._bump_version(conn)
+        return True
     
     def get_all_faces(self) -> List[Dict[str, Any]]:
         """Get all registered faces (without embeddings for security)"""
-        data = self._read_data()
+        rows = self._connect().execute(
+            "SELECT user_id, name, created_at FROM faces ORDER BY rowid"
+        ).fetchall()
         return [
             {
-                "user_id": item["user_id"],
-                "name": item["name"],
-                "created_at": item["created_at"]
+                "user_id": user_id,
+                "name": name,
+                "created_at": created_at
             }
-            for item in data["items"]
+            for user_id, name, created_at in rows
         ]
     
     def get_all_embeddings(self) -> List[Dict[str, Any]]:
-        """Get all faces with embeddings for matching"""
-        data = self._read_data()
-        return data["items"]
+        """Get all faces with embeddings as (k, 512) float32 arrays"""
+        rows = self._connect().execute("""
+            SELECT f.user_id, f.name, f.created_at, e.vec
+            FROM faces f LEFT JOIN embeddings e ON e.user_id = f.user_id
+            ORDER BY f.rowid, e.idx
+        """).fetchall()
+        
+        items = []
+        for (user_id, name, created_at), group in groupby(rows, key=lambda r: r[:3]):
+            blobs = [r[3] for r in group if r[3] is not None]
+            items.append({
+                "user_id": user_id,
+                "name": name,
+                "created_at": created_at,
+                "embeddings": self._decode_embeddings(blobs)
+            })
+        return items
+    
+    def get_embedding_matrix(self) -> EmbeddingGallery:
+        """Get all embeddings stacked for matching (cached until the next write)"""
+        gallery = self._gallery
+        if gallery is not None and self._read_version() == self._cache_version:
+            return gallery
+        
+        # One thread rebuilds; concurrent callers wait and reuse its gallery
+        with self._cache_lock:
+            version = self._read_version()
+            if self._gallery is None or version != self._cache_version:
+                # Rows are read after the version, so a write landing mid-build
+                # only leaves the gallery tagged older than it is (rebuilt next call)
+                gallery = EmbeddingGallery(self.get_all_embeddings())
+                gallery.build_index()
+                self._gallery = gallery
+                self._cache_version = version
+            return self._gallery
     
     def get_face_by_id(self, user_id: str) -> Optional[Dict[str, Any]]:
         """Get a specific face by user_id"""
-        data = self._read_data()
-        for item in data["items"]:
-            if item["user_id"] == user_id:
-                return item
-        return None
+        conn = self._connect()
+        row = conn.execute(
+            "SELECT user_id, name, created_at FROM faces WHERE user_id = ?", (user_id,)
+        ).fetchone()
+        if row is None:
+            return None
+        blobs = conn.execute(
+            "SELECT vec FROM embeddings WHERE user_id = ? ORDER BY idx", (user_id,)
+        ).fetchall()
+        return {
+            "user_id": row[0],
+            "name": row[1],
+            "created_at": row[2],
+            "embeddings": self._decode_embeddings([b[0] for b in blobs])
+        }
     
     def delete_face(self, user_id: str) -> bool:
         """
         Delete a face from storage
         Returns False if user_id doesn't exist
         """
-        data = self._read_data()
-        
-        for i, item in enumerate(data["items"]):
-            if item["user_id"] == user_id:
-                del data["items"][i]
-                self._write_data(data)
-                return True
-        
-        return False
+        conn = self._connect()
+        with conn:
+            cur = conn.execute("DELETE FROM faces WHERE user_id = ?", (user_id,))
+            if cur.rowcount == 0:
+                return False
+            conn.execute("DELETE FROM embeddings WHERE user_id = ?", (user_id,))
+            self._bump_version(conn)
+        return True
     
     def count(self) -> int:
         """Get total number of registered faces"""
-        data = self._read_data()
-        return len(data["items"])
+        return self._connect().execute("SELECT COUNT(*) FROM faces").fetchone()[0]
@@ -0,0 +1,5 @@
+import sys
+from pathlib import Path
+
+# backend modules are imported as top-level scripts (uvicorn main:app)
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
@@ -0,0 +1,44 @@
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+pytest.importorskip("cv2")
+import face_service
+
+
+class _FakeRecognition:
+    """Stands in for the ArcFace model: unnormalized features, like rec.get_feat"""
+    def get_feat(self, crops):
+        rng = np.random.default_rng(len(crops))
+        return rng.normal(scale=30.0, size=(len(crops), 512))
+
+
+def test_batch_embeddings_are_unit_norm(monkeypatch):
+    app = SimpleNamespace(models={"recognition": _FakeRecognition()})
+    monkeypatch.setattr(face_service, "get_face_app", lambda: app)
+    service = face_service.FaceService()
+    monkeypatch.setattr(service, "_align_face", lambda image: (image, "Success"))
+
+    images = [np.zeros((112, 112, 3), dtype=np.uint8) for _ in range(3)]
+    embeddings, status = service.get_face_embeddings_batch(images)
+
+    assert status == "Success"
+    assert embeddings.shape == (3, 512)
+    assert embeddings.dtype == np.float32
+    np.testing.assert_allclose(np.linalg.norm(embeddings, axis=1), 1.0, atol=1e-3)
+
+
+def test_batch_reports_the_failing_image(monkeypatch):
+    service = face_service.FaceService()
+    monkeypatch.setattr(service, "_align_face", lambda image: (None, "No face detected in the image"))
+
+    embeddings, status = service.get_face_embeddings_batch([np.zeros((8, 8, 3), np.uint8)], [2])
+
+    assert embeddings is None
+    assert status == "Image 2: No face detected in the image"
+
+
+def test_empty_image_list():
+    embeddings, status = face_service.FaceService().get_multiple_face_embeddings([])
+    assert embeddings is None
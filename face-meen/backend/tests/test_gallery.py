@@ -0,0 +1,70 @@
+import numpy as np
+import pytest
+
+import storage
+from optional_deps import optional_import
+
+NEVER = 10**9
+
+# name -> (module needed, modules hidden from storage, SQ8_MIN_ROWS, HNSW_MIN_ROWS, FAISS index class)
+BACKENDS = {
+    "faiss_flat": ("faiss", set(), NEVER, NEVER, "IndexFlatIP"),
+    "faiss_sq8": ("faiss", set(), 1, NEVER, "IndexScalarQuantizer"),
+    "faiss_hnsw": ("faiss", set(), NEVER, 1, "IndexHNSWFlat"),
+    "faiss_hnsw_sq8": ("faiss", set(), 1, 1, "IndexHNSWSQ"),
+    "numba": ("numba", {"faiss"}, NEVER, NEVER, None),
+    "simsimd": ("simsimd", {"faiss", "numba"}, NEVER, NEVER, None),
+    "numpy": (None, {"faiss", "numba", "simsimd"}, NEVER, NEVER, None),
+}
+
+
+def _make_items(rng, n_users):
+    return [
+        {
+            "user_id": f"u{i}",
+            "name": f"User {i}",
+            "embeddings": rng.normal(size=(rng.integers(1, 4), storage.EMBEDDING_DIM)).astype(np.float32),
+        }
+        for i in range(n_users)
+    ]
+
+
+def _brute_force(gallery, queries):
+    per_user = np.maximum.reduceat(queries @ gallery.matrix.T, gallery.offsets, axis=1)
+    return per_user.argmax(axis=1), per_user.max(axis=1)
+
+
+@pytest.mark.parametrize("backend", BACKENDS)
+def test_search_matches_brute_force(backend, monkeypatch):
+    needed, hidden, sq8_min_rows, hnsw_min_rows, index_name = BACKENDS[backend]
+    if needed:
+        pytest.importorskip(needed)
+    monkeypatch.setattr(storage, "optional_import", lambda name: None if name in hidden else optional_import(name))
+    if "numba" in hidden:
+        monkeypatch.setattr(storage, "_best_match_kernel", lambda: None)
+    monkeypatch.setattr(storage, "SQ8_MIN_ROWS", sq8_min_rows)
+    monkeypatch.setattr(storage, "HNSW_MIN_ROWS", hnsw_min_rows)
+    # Compare the full scan (several blocks) rather than the first certain match
+    monkeypatch.setattr(storage, "EARLY_EXIT_THRESHOLD", 2.0)
+    monkeypatch.setattr(storage, "SCAN_BLOCK_ROWS", 64)
+
+    rng = np.random.default_rng(0)
+    gallery = storage.EmbeddingGallery(_make_items(rng, 300))
+    # Noisy copies of stored rows: one clear winner per query, as with a real face
+    queries = gallery.matrix[rng.integers(0, len(gallery.matrix), 16)]
+    queries = queries + 0.02 * rng.normal(size=queries.shape).astype(np.float32)
+    queries /= np.linalg.norm(queries, axis=1, keepdims=True)
+
+    users, scores = gallery.search(queries)
+
+    index = gallery._get_index()
+    assert (type(index).__name__ if index is not None else None) == index_name
+    expected_users, expected_scores = _brute_force(gallery, queries)
+    np.testing.assert_array_equal(users, expected_users)
+    np.testing.assert_allclose(scores, expected_scores, atol=1e-4)
+
+
+def test_empty_gallery():
+    gallery = storage.EmbeddingGallery([])
+    assert len(gallery) == 0
+    assert gallery.matrix.shape == (0, storage.EMBEDDING_DIM)
@@ -0,0 +1,72 @@
+import json
+
+import numpy as np
+import pytest
+
+from storage import EMBEDDING_DIM, FaceStorage
+
+
+def _embeddings(n, seed=0):
+    return np.random.default_rng(seed).normal(size=(n, EMBEDDING_DIM)).astype(np.float32)
+
+
+def test_add_update_delete(tmp_path):
+    store = FaceStorage(tmp_path / "faces.db")
+    first = _embeddings(3)
+
+    assert store.add_face("u1", "Alice", first)
+    assert not store.add_face("u1", "Alice again", first)
+    face = store.get_face_by_id("u1")
+    assert face["name"] == "Alice"
+    np.testing.assert_array_equal(face["embeddings"], first)
+
+    second = _embeddings(2, seed=1)
+    assert store.update_face("u1", "Alicia", second)
+    assert not store.update_face("missing", "Nobody", second)
+    face = store.get_face_by_id("u1")
+    assert face["name"] == "Alicia"
+    np.testing.assert_array_equal(face["embeddings"], second)
+
+    gallery = store.get_embedding_matrix()
+    assert [u["user_id"] for u in gallery.users] == ["u1"]
+    assert gallery.matrix.shape == (2, EMBEDDING_DIM)
+
+    assert store.delete_face("u1")
+    assert not store.delete_face("u1")
+    assert store.get_face_by_id("u1") is None
+    assert store.count() == 0
+    assert len(store.get_embedding_matrix()) == 0
+
+
+def test_legacy_json_import(tmp_path):
+    e1, e2, e3 = _embeddings(3).tolist()
+    items = [
+        {"user_id": "u1", "name": "Alice", "created_at": "2024-01-01T00:00:00", "embeddings": [e1, e2]},
+        {"user_id": "u2", "name": "Bob", "created_at": "2024-01-02T00:00:00", "embedding": e3},
+        # Duplicate user_id: the first entry wins
+        {"user_id": "u1", "name": "Alice (dup)", "created_at": "2024-01-03T00:00:00", "embeddings": [e3]},
+    ]
+    (tmp_path / "faces.json").write_text(json.dumps({"items": items}), encoding="utf-8")
+
+    store = FaceStorage(tmp_path / "faces.db")
+    assert [f["user_id"] for f in store.get_all_faces()] == ["u1", "u2"]
+    alice = store.get_face_by_id("u1")
+    assert alice["name"] == "Alice"
+    np.testing.assert_allclose(alice["embeddings"], [e1, e2])
+    np.testing.assert_allclose(store.get_face_by_id("u2")["embeddings"], [e3])
+
+    # Deleting everyone must not bring the file's faces back on the next start
+    store.delete_face("u1")
+    store.delete_face("u2")
+    assert FaceStorage(tmp_path / "faces.db").count() == 0
+
+
+def test_model_mismatch_refuses_to_open(tmp_path):
+    store = FaceStorage(tmp_path / "faces.db", model_name="buffalo_sc")
+    store.add_face("u1", "Alice", _embeddings(1))
+
+    with pytest.raises(RuntimeError):
+        FaceStorage(tmp_path / "faces.db", model_name="buffalo_l")
+
+    store.delete_face("u1")
+    FaceStorage(tmp_path / "faces.db", model_name="buffalo_l")